@@ -5,60 +5,160 @@ Based on the Sease tutorial for Apache Solr Neural Search.
 """
 
 import sys
+import gzip
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import orjson
 import pysolr
+import requests
+from requests.adapters import HTTPAdapter
 import os
 
 # Solr configuration
 SOLR_ADDRESS = os.getenv('SOLR_URL', 'http://localhost:8983/solr/ms-marco')
-BATCH_SIZE = 100
+BATCH_SIZE = 500
+VECTOR_DIMENSION = 384
+# Batches are sent to Solr from worker threads while the next one is built
+INDEXING_THREADS = 3
+MAX_PENDING_BATCHES = 6
+# Documents are indexed grouped by k-means cluster of their vectors
+CLUSTER_COUNT = 64
+MIN_CLUSTER_SIZE = 2
+# Gzip update bodies; Solr's Jetty must have request inflation enabled
+SOLR_GZIP = os.getenv('SOLR_GZIP', 'false').lower() in ('1', 'true', 'yes')
 
 def create_solr_client():
     """Create a Solr client instance."""
     print(f"Connecting to Solr at: {SOLR_ADDRESS}")
-    return pysolr.Solr(SOLR_ADDRESS, always_commit=True, timeout=10)
+    return pysolr.Solr(SOLR_ADDRESS, always_commit=False, timeout=60)
 
-def index_documents(solr, documents_filename, embedding_filename):
-    """Index documents with their corresponding vectors into Solr."""
+def create_http_session():
+    """Create a pooled HTTP session for posting update batches."""
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=INDEXING_THREADS))
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=INDEXING_THREADS))
+    return session
+
+def post_batch(session, documents):
+    """Post a batch of documents to Solr's JSON update handler without committing."""
+    # orjson writes numpy vectors natively, without per-float Python objects
+    payload = orjson.dumps(documents, option=orjson.OPT_SERIALIZE_NUMPY)
+    headers = {'Content-Type': 'application/json'}
+    if SOLR_GZIP:
+        payload = gzip.compress(payload, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    
+    response = session.post(f"{SOLR_ADDRESS}/update", data=payload, headers=headers,
+                            params={'commit': 'false'}, timeout=60)
+    response.raise_for_status()
+
+def load_vectors(embedding_filename):
+    """Load all vectors as an (N, VECTOR_DIMENSION) float32 array.
+    
+    Raw .f32 files are memory-mapped, so nothing is parsed or copied up
+    front. Unparseable rows of a .tsv file become NaN rows, which
+    index_documents skips.
+    """
+    if embedding_filename.endswith('.f32'):
+        # Binary companion written by vector_generation.py
+        vectors = np.memmap(embedding_filename, dtype=np.float32, mode='r')
+        return vectors.reshape(-1, VECTOR_DIMENSION)
+    
+    rows = []
+    with open(embedding_filename, "r", encoding="utf-8") as vectors_file:
+        for index, vector_string in enumerate(vectors_file):
+            try:
+                # Parse vector string to float array in a single C-level pass
+                vector = np.fromstring(vector_string, sep=',', dtype=np.float32)
+                if vector.size != VECTOR_DIMENSION:
+                    raise ValueError(f"expected {VECTOR_DIMENSION} values, got {vector.size}")
+            except ValueError as e:
+                print(f"Error processing document {index}: {e}")
+                vector = np.full(VECTOR_DIMENSION, np.nan, dtype=np.float32)
+            rows.append(vector)
+    return np.stack(rows) if rows else np.empty((0, VECTOR_DIMENSION), dtype=np.float32)
+
+def cluster_order(vectors):
+    """Return document indices grouped by k-means cluster of their vectors.
+    
+    Indexing nearby vectors together keeps them in the same segments, which
+    reduces HNSW graph rebuilding during merges.
+    """
+    # Optional dependency, only needed when sorting is enabled
+    from sklearn.cluster import MiniBatchKMeans
+    
+    # Keep at least MIN_CLUSTER_SIZE vectors per cluster on small corpora
+    n_clusters = min(CLUSTER_COUNT, len(vectors) // MIN_CLUSTER_SIZE)
+    if n_clusters < 2:
+        return np.arange(len(vectors))
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, random_state=0)
+    # Unparseable (NaN) rows are skipped later; give them a neutral value here
+    labels = kmeans.fit_predict(np.nan_to_num(vectors))
+    return np.argsort(labels, kind='stable')
+
+def submit_batch(pool, pending, session, documents):
+    """Send a batch to Solr in the background, blocking while too many are in flight."""
+    pending.add(pool.submit(post_batch, session, documents))
+    
+    if len(pending) >= MAX_PENDING_BATCHES:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            # Re-raise any indexing error in the main thread
+            future.result()
+        pending -= done
+
+def index_documents(session, documents_filename, embedding_filename, sort_by_cluster=True):
+    """Index documents with their corresponding vectors into Solr.
+    
+    Document ids are always the line numbers; with sort_by_cluster only the
+    order in which they are sent to Solr changes.
+    """
     print(f"Indexing documents from: {documents_filename}")
     print(f"Using vectors from: {embedding_filename}")
     
-    # Open the file containing text
     with open(documents_filename, "r", encoding="utf-8") as documents_file:
-        # Open the file containing vectors
-        with open(embedding_filename, "r", encoding="utf-8") as vectors_file:
-            documents = []
+        texts = [document.strip() for document in documents_file]
+    vectors = load_vectors(embedding_filename)
+    
+    total = min(len(texts), len(vectors))
+    if len(texts) != len(vectors):
+        print(f"Warning: {len(texts)} documents but {len(vectors)} vectors, indexing the first {total}")
+    
+    order = None
+    if sort_by_cluster and total > 0:
+        print(f"Clustering {total} vectors to order indexing")
+        order = cluster_order(vectors[:total])
+    
+    pending = set()
+    with ThreadPoolExecutor(max_workers=INDEXING_THREADS) as pool:
+        # Index batches of documents at a time
+        for start in range(0, total, BATCH_SIZE):
+            stop = min(start + BATCH_SIZE, total)
+            if order is None:
+                # Streaming order: slice the vectors directly
+                ids = np.arange(start, stop)
+                batch = vectors[start:stop]
+            else:
+                ids = order[start:stop]
+                batch = vectors[ids]
             
-            # For each document, create a JSON document including both text and related vector
-            for index, (document, vector_string) in enumerate(zip(documents_file, vectors_file)):
-                try:
-                    # Parse vector string to float array
-                    vector = [float(w) for w in vector_string.strip().split(",")]
-                    
-                    # Create document
-                    doc = {
-                        "id": str(index),
-                        "text": document.strip(),
-                        "vector": vector
-                    }
-                    
-                    # Append JSON document to list
-                    documents.append(doc)
-                    
-                    # Index batches of documents at a time
-                    if index % BATCH_SIZE == 0 and index != 0:
-                        # Index data to Solr
-                        solr.add(documents)
-                        documents = []
-                        print(f"==== Indexed {index} documents ======")
-                
-                except ValueError as e:
-                    print(f"Error processing document {index}: {e}")
-                    continue
+            # Plain ndarray (not memmap) so orjson can serialize the rows
+            batch = np.ascontiguousarray(batch)
+            valid = ~np.isnan(batch).any(axis=1)
             
-            # Index the remaining documents when list < BATCH_SIZE
-            if documents:
-                solr.add(documents)
-                print(f"==== Indexed remaining {len(documents)} documents ======")
+            # Create JSON documents including both text and related vector
+            documents = [
+                {"id": str(ids[i]), "text": texts[ids[i]], "vector": batch[i]}
+                for i in np.flatnonzero(valid)
+            ]
+            
+            # Index data to Solr
+            submit_batch(pool, pending, session, documents)
+            print(f"==== Indexed {start + len(batch)} documents ======")
+        
+        # Wait for the in-flight batches to finish
+        for future in pending:
+            future.result()
     
     print("Indexing finished!")
 
@@ -74,13 +174,17 @@ def test_connection(solr):
         return False
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python document_indexing.py <documents_file> <vectors_file>")
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    sort_by_cluster = '--no-sort' not in sys.argv[1:]
+    
+    if len(args) != 2:
+        print("Usage: python document_indexing.py <documents_file> <vectors_file> [--no-sort]")
         print("Example: python document_indexing.py data/documents_10k.tsv data/vectors_documents_10k.tsv")
+        print("         python document_indexing.py data/documents_10k.tsv data/vectors_documents_10k.f32")
         sys.exit(1)
     
-    documents_filename = sys.argv[1]
-    embedding_filename = sys.argv[2]
+    documents_filename = args[0]
+    embedding_filename = args[1]
     
     # Check if input files exist
     if not os.path.exists(documents_filename):
@@ -101,7 +205,11 @@ def main():
     
     # Index documents
     try:
-        index_documents(solr, documents_filename, embedding_filename)
+        index_documents(create_http_session(), documents_filename, embedding_filename, sort_by_cluster)
+        
+        # Single hard commit once everything is added
+        solr.commit()
+        print("Commit finished!")
     except Exception as e:
         print(f"Error during indexing: {e}")
         sys.exit(1)
@@ -5,26 +5,126 @@ Implements all methods from the Sease tutorial.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import sys
 import os
+import hashlib
+import io
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
+import torch
+import numpy as np
 import time
 
 SOLR_URL = os.getenv('SOLR_URL', 'http://localhost:8983/solr/ms-marco')
 MODEL_NAME = 'all-MiniLM-L6-v2'
+TEST_WORKERS = 8
+QUERY_CACHE_FILE = os.getenv('QUERY_CACHE_FILE', 'data/query_vectors_cache.pkl')
+
+def query_cache_key(query):
+    """Cache key for a query embedding, scoped to the model that produced it."""
+    return hashlib.sha256(f"{MODEL_NAME}:{query}".encode('utf-8')).hexdigest()
+
+def format_vector(vector):
+    """Render a vector as a compact Solr knn literal (6 significant digits)."""
+    return "[" + ",".join(np.char.mod('%.6g', vector)) + "]"
+
+class ThreadLocalStdout:
+    """sys.stdout proxy that lets worker threads buffer their own output."""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def run_buffered(self, test, kwargs):
+        """Run a test in the calling thread, returning (result, output, error)."""
+        self.local.buffer = io.StringIO()
+        result, error = None, None
+        try:
+            result = test(**kwargs)
+        except Exception as e:
+            error = e
+        finally:
+            output = self.local.buffer.getvalue()
+            self.local.buffer = None
+        return result, output, error
 
 class NeuralSearchTester:
     def __init__(self):
         self.solr_url = SOLR_URL
         self.model = SentenceTransformer(MODEL_NAME)
+        self.query_cache = self.load_query_cache()
+        # Tests run concurrently; only one thread may use the model at a time
+        self.model_lock = threading.Lock()
+        self.session = self.create_session()
         print(f"Initialized Neural Search Tester")
         print(f"Solr URL: {self.solr_url}")
     
+    def create_session(self):
+        """Create a pooled keep-alive HTTP session shared by all Solr requests."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=Retry(total=2, backoff_factor=0.1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        return session
+    
+    def load_query_cache(self):
+        """Load query embeddings persisted by previous runs."""
+        if not os.path.exists(QUERY_CACHE_FILE):
+            return {}
+        
+        try:
+            with open(QUERY_CACHE_FILE, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Ignoring unreadable query cache {QUERY_CACHE_FILE}: {e}")
+            return {}
+    
+    def save_query_cache(self):
+        """Persist query embeddings so later runs skip the model."""
+        try:
+            os.makedirs(os.path.dirname(QUERY_CACHE_FILE) or '.', exist_ok=True)
+            with open(QUERY_CACHE_FILE, 'wb') as f:
+                pickle.dump(self.query_cache, f)
+        except OSError as e:
+            print(f"Could not save query cache {QUERY_CACHE_FILE}: {e}")
+    
     def vectorize_query(self, query):
-        """Convert text query to vector."""
-        embeddings = self.model.encode([query])
-        return embeddings[0].tolist()
+        """Convert text query to vector, reusing cached embeddings."""
+        key = query_cache_key(query)
+        if key not in self.query_cache:
+            with self.model_lock, torch.inference_mode():
+                vector = self.model.encode([query], normalize_embeddings=True,
+                                           convert_to_numpy=True)[0]
+            # Read-only so callers cannot mutate the cached vector
+            vector.setflags(write=False)
+            self.query_cache[key] = vector
+        return self.query_cache[key]
+    
+    def vectorize_queries(self, queries):
+        """Convert several text queries to vectors with a single model call."""
+        missing = [q for q in dict.fromkeys(queries) if query_cache_key(q) not in self.query_cache]
+        if missing:
+            with self.model_lock, torch.inference_mode():
+                embeddings = self.model.encode(missing, batch_size=8, normalize_embeddings=True,
+                                               convert_to_numpy=True)
+            embeddings.setflags(write=False)
+            for query, embedding in zip(missing, embeddings):
+                self.query_cache[query_cache_key(query)] = embedding
+        return [self.query_cache[query_cache_key(q)] for q in queries]
     
     def make_request(self, endpoint, data=None, method='GET'):
         """Make HTTP request to Solr."""
@@ -34,9 +134,9 @@ class NeuralSearchTester:
             start_time = time.time()
             if method == 'POST':
                 headers = {'Content-Type': 'application/json'}
-                response = requests.post(url, json=data, headers=headers, timeout=30)
+                response = self.session.post(url, json=data, headers=headers, timeout=30)
             else:
-                response = requests.get(url, timeout=30)
+                response = self.session.get(url, timeout=30)
             
             response.raise_for_status()
             end_time = time.time()
@@ -47,18 +147,19 @@ class NeuralSearchTester:
             print(f"Error making request to {url}: {e}")
             return None
     
-    def test_basic_knn_query(self, query="what is a bank transit number", top_k=3):
+    def test_basic_knn_query(self, query="what is a bank transit number", top_k=3,
+                             precomputed_vector=None):
         """Test 1: Basic KNN Query"""
         print(f"\n=== Test 1: Basic KNN Query ===")
         print(f"Query: '{query}'")
         print(f"TopK: {top_k}")
         
-        # Vectorize query
-        vector = self.vectorize_query(query)
+        # Vectorize query unless the caller already did
+        vector = precomputed_vector if precomputed_vector is not None else self.vectorize_query(query)
         
         # Build KNN query
         query_data = {
-            "query": f"{{!knn f=vector topK={top_k}}}{vector}"
+            "query": f"{{!knn f=vector topK={top_k}}}{format_vector(vector)}"
         }
         
         # Execute query
@@ -78,20 +179,21 @@ class NeuralSearchTester:
         return result
     
     def test_knn_with_prefiltering(self, query="what is a bank transit number", 
-                                   filter_ids=["0", "1", "2", "3", "4"], top_k=3):
+                                   filter_ids=["0", "1", "2", "3", "4"], top_k=3,
+                                   precomputed_vector=None):
         """Test 2: KNN with Pre-filtering"""
         print(f"\n=== Test 2: KNN with Pre-filtering ===")
         print(f"Query: '{query}'")
         print(f"Filter IDs: {filter_ids}")
         print(f"TopK: {top_k}")
         
-        # Vectorize query
-        vector = self.vectorize_query(query)
+        # Vectorize query unless the caller already did
+        vector = precomputed_vector if precomputed_vector is not None else self.vectorize_query(query)
         
         # Build KNN query with filter
         filter_query = f"id:({' '.join(filter_ids)})"
         query_data = {
-            "query": f"{{!knn f=vector topK={top_k}}}{vector}",
+            "query": f"{{!knn f=vector topK={top_k}}}{format_vector(vector)}",
             "filter": filter_query
         }
         
@@ -118,15 +220,16 @@ class NeuralSearchTester:
         return result
     
     def test_hybrid_search(self, query="what is a bank transit number", 
-                          lexical_field="text", lexical_query="bank", top_k=3):
+                          lexical_field="text", lexical_query="bank", top_k=3,
+                          precomputed_vector=None):
         """Test 3: Hybrid Search (Dense + Sparse)"""
         print(f"\n=== Test 3: Hybrid Search ===")
         print(f"Neural query: '{query}'")
         print(f"Lexical query: '{lexical_query}' in field '{lexical_field}'")
         print(f"TopK: {top_k}")
         
-        # Vectorize query
-        vector = self.vectorize_query(query)
+        # Vectorize query unless the caller already did
+        vector = precomputed_vector if precomputed_vector is not None else self.vectorize_query(query)
         
         # Build hybrid query using boolean query parser
         query_data = {
@@ -134,7 +237,7 @@ class NeuralSearchTester:
                 "bool": {
                     "should": [
                         f"{{!type=edismax qf={lexical_field} v='{lexical_query}'}}",
-                        f"{{!knn f=vector topK={top_k}}}{vector}"
+                        f"{{!knn f=vector topK={top_k}}}{format_vector(vector)}"
                     ]
                 }
             }
@@ -158,28 +261,28 @@ class NeuralSearchTester:
     
     def test_reranking_query(self, initial_query="id:(0 1 2 3 4)", 
                            rerank_query="what is a bank transit number", 
-                           rerank_docs=4, rerank_weight=1):
+                           rerank_docs=4, rerank_weight=1, precomputed_vector=None):
         """Test 4: Re-ranking Query"""
         print(f"\n=== Test 4: Re-ranking Query ===")
         print(f"Initial query: '{initial_query}'")
         print(f"Rerank query: '{rerank_query}'")
         print(f"Rerank docs: {rerank_docs}, weight: {rerank_weight}")
         
-        # Vectorize reranking query
-        vector = self.vectorize_query(rerank_query)
+        # Vectorize reranking query unless the caller already did
+        vector = precomputed_vector if precomputed_vector is not None else self.vectorize_query(rerank_query)
         
         # Build reranking query
         params = {
             'q': initial_query,
             'fl': 'id,text,score',
             'rq': f'{{!rerank reRankQuery=$rqq reRankDocs={rerank_docs} reRankWeight={rerank_weight}}}',
-            'rqq': f'{{!knn f=vector topK={rerank_docs}}}{vector}'
+            'rqq': f'{{!knn f=vector topK={rerank_docs}}}{format_vector(vector)}'
         }
         
         # Execute query
         url = f"{self.solr_url}/select"
         try:
-            response = requests.get(url, data=params, timeout=30)
+            response = self.session.get(url, data=params, timeout=30)
             response.raise_for_status()
             result = response.json()
         except Exception as e:
@@ -198,18 +301,17 @@ class NeuralSearchTester:
         """Test Solr health and collection status"""
         print(f"\n=== Solr Health Check ===")
         
-        # Ping test
-        ping_result = self.make_request("/admin/ping")
-        if ping_result:
-            print(f"✓ Solr ping successful: {ping_result.get('status')}")
+        # A single Luke request proves the core is up and returns its stats
+        luke_result = self.make_request("/admin/luke?show=index&numTerms=0&wt=json")
+        if luke_result:
+            print(f"✓ Solr core is reachable")
         else:
-            print("✗ Solr ping failed")
+            print("✗ Solr health request failed")
             return False
         
         # Collection stats
-        stats_result = self.make_request("/select?q=*:*&rows=0")
-        if stats_result:
-            num_docs = stats_result['response']['numFound']
+        num_docs = luke_result.get('index', {}).get('numDocs')
+        if num_docs is not None:
             print(f"✓ Collection has {num_docs} documents")
         else:
             print("✗ Failed to get collection stats")
@@ -266,53 +368,54 @@ class NeuralSearchTester:
             "federal tax identification"
         ]
         
-        success_count = 0
-        total_tests = 0
-        
-        for query in test_queries:
-            print(f"\n{'='*50}")
-            print(f"Testing with query: '{query}'")
-            print(f"{'='*50}")
-            
-            # Test 1: Basic KNN
-            total_tests += 1
-            if self.test_basic_knn_query(query):
-                success_count += 1
-            
-            # Test 2: KNN with filtering  
-            total_tests += 1
-            if self.test_knn_with_prefiltering(query):
-                success_count += 1
-            
-            # Test 3: Hybrid search
-            total_tests += 1
-            if self.test_hybrid_search(query):
-                success_count += 1
-            
-            # Test 4: Reranking
-            total_tests += 1
-            if self.test_reranking_query(rerank_query=query):
-                success_count += 1
+        # Encode all test queries in one batch up front
+        query_vectors = self.vectorize_queries(test_queries)
+        
+        tests = []
+        for query, vector in zip(test_queries, query_vectors):
+            tests += [
+                # Test 1: Basic KNN
+                (self.test_basic_knn_query, {'query': query, 'precomputed_vector': vector}),
+                # Test 2: KNN with filtering
+                (self.test_knn_with_prefiltering, {'query': query, 'precomputed_vector': vector}),
+                # Test 3: Hybrid search
+                (self.test_hybrid_search, {'query': query, 'precomputed_vector': vector}),
+                # Test 4: Reranking
+                (self.test_reranking_query, {'rerank_query': query, 'precomputed_vector': vector}),
+            ]
         
         # Additional negative tests
+        tests += [
+            # Test 5: Empty Query
+            (self.test_empty_query, {}),
+            # Test 6: Out-of-Vocabulary Query
+            (self.test_out_of_vocabulary_query, {}),
+            # Test 7: Invalid Filter
+            (self.test_invalid_filter, {}),
+        ]
+        
         print(f"\n{'='*50}")
-        print(f"Testing Negative Scenarios")
+        print(f"Running {len(tests)} tests with {TEST_WORKERS} workers")
         print(f"{'='*50}")
         
-        # Test 5: Empty Query
-        total_tests += 1
-        if self.test_empty_query():
-            success_count += 1
-        
-        # Test 6: Out-of-Vocabulary Query
-        total_tests += 1
-        if self.test_out_of_vocabulary_query():
-            success_count += 1
-        
-        # Test 7: Invalid Filter
-        total_tests += 1
-        if self.test_invalid_filter():
-            success_count += 1
+        # Solr serves the requests concurrently, so dispatch them in parallel;
+        # each test's output is buffered and printed in submission order
+        success_count = 0
+        total_tests = len(tests)
+        stdout = ThreadLocalStdout(sys.stdout)
+        sys.stdout = stdout
+        try:
+            with ThreadPoolExecutor(max_workers=TEST_WORKERS) as pool:
+                futures = [pool.submit(stdout.run_buffered, test, kwargs) for test, kwargs in tests]
+                for future in futures:
+                    result, output, error = future.result()
+                    stdout.stream.write(output)
+                    if error is not None:
+                        raise error
+                    if result:
+                        success_count += 1
+        finally:
+            sys.stdout = stdout.stream
         
         print(f"\n{'='*50}")
         print(f"TEST SUMMARY")
@@ -369,6 +472,8 @@ def main():
     else:
         print(f"Unknown command: {command}")
         sys.exit(1)
+    
+    tester.save_query_cache()
 
 if __name__ == "__main__":
     main()
@@ -5,40 +5,78 @@ Based on the Sease tutorial for Apache Solr Neural Search.
 """
 
 from sentence_transformers import SentenceTransformer
+import torch
+import numpy as np
 import sys
+import os
 import json
 
 MODEL_NAME = 'all-MiniLM-L6-v2'
+STDIN_BATCH_SIZE = 64
 
-def load_model():
+def load_model(use_fp16=False):
     """Load the sentence transformer model."""
-    print(f"Loading model: {MODEL_NAME}")
-    return SentenceTransformer(MODEL_NAME)
+    # Status goes to stderr so --stdin output stays machine-readable
+    print(f"Loading model: {MODEL_NAME}", file=sys.stderr)
+    model = SentenceTransformer(MODEL_NAME)
+    
+    if torch.cuda.is_available():
+        model = model.to(torch.device("cuda"))
+        if use_fp16:
+            model = model.half()
+    else:
+        torch.set_num_threads(os.cpu_count() or 1)
+    
+    return model
 
 def vectorize_query(model, query):
     """Convert a text query into a vector embedding."""
     print(f"Vectorizing query: '{query}'")
     
     # Encode the query
-    embeddings = model.encode([query])
-    vector = embeddings[0].tolist()
+    with torch.inference_mode():
+        vector = model.encode([query], normalize_embeddings=True, convert_to_numpy=True)[0]
     
     print(f"Generated vector with {len(vector)} dimensions")
     return vector
 
+def vectorize_stdin(model, output_json):
+    """Vectorize newline-delimited queries from stdin with one batched encode call."""
+    # Blank lines are kept (encoded as "") so output line N matches input line N
+    queries = [line.strip() for line in sys.stdin]
+    print(f"Vectorizing {len(queries)} queries from stdin", file=sys.stderr)
+    
+    with torch.inference_mode():
+        vectors = model.encode(queries, batch_size=STDIN_BATCH_SIZE,
+                               convert_to_numpy=True, normalize_embeddings=True)
+    
+    # One line per query, in input order
+    for query, vector in zip(queries, vectors):
+        if output_json:
+            print(json.dumps({"query": query, "vector": vector.tolist(), "dimension": len(vector)}))
+        else:
+            print(','.join(np.char.mod('%.6g', vector)))
+
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python query_vectorizer.py <query_text> [--json]")
+        print("Usage: python query_vectorizer.py <query_text|--stdin> [--json] [--fp16]")
         print("Examples:")
         print("  python query_vectorizer.py 'what is a bank transit number'")
         print("  python query_vectorizer.py 'what is a bank transit number' --json")
+        print("  python query_vectorizer.py --stdin < queries.txt > query_vectors.csv")
         sys.exit(1)
     
     query = sys.argv[1]
-    output_json = len(sys.argv) > 2 and sys.argv[2] == '--json'
+    output_json = '--json' in sys.argv[2:]
+    use_fp16 = '--fp16' in sys.argv[2:]
     
     # Load model
-    model = load_model()
+    model = load_model(use_fp16)
+    
+    # Batch mode: one query per stdin line, one vector per output line
+    if query in ('-', '--stdin'):
+        vectorize_stdin(model, output_json)
+        return
     
     # Vectorize query
     vector = vectorize_query(model, query)
@@ -47,14 +85,14 @@ def main():
         # Output as JSON for easier parsing
         result = {
             "query": query,
-            "vector": vector,
+            "vector": vector.tolist(),
             "dimension": len(vector)
         }
         print(json.dumps(result, indent=2))
     else:
         # Output as comma-separated values
         print("Vector:")
-        print(','.join([str(v) for v in vector]))
+        print(','.join(np.char.mod('%.6g', vector)))
 
 if __name__ == "__main__":
     main()
@@ -4,18 +4,148 @@ Script to generate vector embeddings from text documents.
 Based on the Sease tutorial for Apache Solr Neural Search.
 """
 
+import os
+
+# Thread pools of OpenMP/MKL are sized when torch is first imported
+CPU_THREADS = int(os.getenv('TORCH_NUM_THREADS', os.cpu_count() or 8))
+os.environ.setdefault('OMP_NUM_THREADS', str(CPU_THREADS))
+os.environ.setdefault('MKL_NUM_THREADS', str(CPU_THREADS))
+
 from sentence_transformers import SentenceTransformer
+import diskcache
+import hashlib
 import torch
 import sys
 from itertools import islice
-import os
+import numpy as np
 
-BATCH_SIZE = 100
+# Lines read from the input file per iteration; encode() length-sorts
+# within this window, so larger windows mean less padding per mini-batch
+SUPER_BATCH_SIZE = 4096
+ENCODE_BATCH_SIZE = 64
 INFO_UPDATE_FACTOR = 1
 MODEL_NAME = 'all-MiniLM-L6-v2'
+MAX_SEQ_LENGTH = 256
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', 'data/vectors.cache')
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', f'models/{MODEL_NAME}-onnx-int8')
+
+class OnnxSentenceEncoder:
+    """INT8 ONNX Runtime stand-in for SentenceTransformer.encode().
+    
+    Reproduces the all-MiniLM-L6-v2 pipeline: mean pooling over the
+    attention mask followed by L2 normalisation.
+    """
+    
+    def __init__(self, model_dir):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name='model_quantized.onnx', provider='CPUExecutionProvider')
+    
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """Encode sentences into a 2-D float32 array."""
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(sentences[start:start + batch_size], padding=True,
+                                    truncation=True, max_length=MAX_SEQ_LENGTH,
+                                    return_tensors='np')
+            token_embeddings = self.model(**inputs).last_hidden_state
+            
+            # Mean pooling over real (non-padding) tokens
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append((pooled / norms).astype(np.float32))
+        return np.concatenate(batches)
+
+def export_onnx_model(model_dir):
+    """One-time export of the model to ONNX with dynamic INT8 quantization."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    print(f"Exporting {MODEL_NAME} to ONNX in: {model_dir}")
+    hub_id = f'sentence-transformers/{MODEL_NAME}'
+    ort_model = ORTModelForFeatureExtraction.from_pretrained(hub_id, export=True)
+    ort_model.save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(hub_id).save_pretrained(model_dir)
+    
+    # Writes model_quantized.onnx next to the FP32 export
+    quantizer = ORTQuantizer.from_pretrained(ort_model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+
+def load_onnx_model():
+    """Load the INT8 ONNX Runtime encoder, exporting it on first use."""
+    try:
+        if not os.path.exists(os.path.join(ONNX_MODEL_DIR, 'model_quantized.onnx')):
+            export_onnx_model(ONNX_MODEL_DIR)
+        model = OnnxSentenceEncoder(ONNX_MODEL_DIR)
+    except ImportError as e:
+        print(f"Error: --onnx requires optimum[onnxruntime] ({e})")
+        sys.exit(1)
+    
+    print(f"Using ONNX Runtime INT8 model from: {ONNX_MODEL_DIR}")
+    return model
 
-def load_model():
+class CompiledWithFallback(torch.nn.Module):
+    """Run a torch.compile'd module, dropping back to eager mode if compilation fails.
+    
+    Length-sorted batches reach the model with many different padded
+    shapes, and any of them may trigger a recompile, not just the warm-up.
+    """
+    
+    def __init__(self, module):
+        super().__init__()
+        self.eager = module
+        # Default mode: 'reduce-overhead' would record a CUDA graph per shape
+        self.compiled = torch.compile(module, dynamic=True)
+        self.use_compiled = True
+        # SentenceTransformer reads the HF config from auto_model
+        self.config = getattr(module, 'config', None)
+    
+    def forward(self, *args, **kwargs):
+        if self.use_compiled:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                print(f"torch.compile failed, using eager mode: {e}")
+                self.use_compiled = False
+        return self.eager(*args, **kwargs)
+
+def compile_model(model):
+    """Compile the transformer forward pass with torch.compile (PyTorch 2.x)."""
+    if not hasattr(torch, 'compile'):
+        print("torch.compile is not available in this PyTorch version, using eager mode")
+        return model
+    
+    transformer = model._first_module()
+    transformer.auto_model = CompiledWithFallback(transformer.auto_model)
+    
+    # Compile now so the first real batch does not pay for it
+    with torch.inference_mode():
+        model.encode(['warmup'] * 8, show_progress_bar=False)
+    if transformer.auto_model.use_compiled:
+        print("Using torch.compile'd model")
+    
+    return model
+
+def load_model(use_fp16=False, use_onnx=False, use_compile=False):
     """Load or create a SentenceTransformer model."""
+    # Size the intra-op pool explicitly, torch's guess is often off in containers
+    torch.set_num_threads(CPU_THREADS)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        pass
+    torch.backends.mkldnn.enabled = True
+    
+    if use_onnx:
+        return load_onnx_model()
+    
     print(f"Loading model: {MODEL_NAME}")
     model = SentenceTransformer(MODEL_NAME)
     
@@ -23,49 +153,122 @@ def load_model():
     if torch.cuda.is_available():
         model = model.to(torch.device("cuda"))
         print(f"Using device: cuda")
+        if use_fp16:
+            # Half precision halves memory traffic and runs on tensor cores
+            model = model.half()
+            print("Using FP16 weights")
     else:
+        if use_fp16:
+            print("FP16 requested but CUDA is not available, keeping FP32")
         print(f"Using device: cpu")
     
+    if use_compile:
+        model = compile_model(model)
+    
     return model
 
-def batch_encode_to_vectors(model, input_filename, output_filename):
-    """Process documents in batches and generate vector embeddings."""
+def binary_vectors_filename(output_filename):
+    """Return the path of the raw float32 companion of a vectors file."""
+    return os.path.splitext(output_filename)[0] + '.f32'
+
+def embedding_cache_tag(model):
+    """Name the model variant actually loaded, since its embeddings differ slightly."""
+    if isinstance(model, OnnxSentenceEncoder):
+        return MODEL_NAME + '-onnx-int8'
+    # --fp16 is ignored on CPU, so look at the weights rather than the flag
+    if next(model.parameters()).dtype == torch.float16:
+        return MODEL_NAME + '-fp16'
+    return MODEL_NAME
+
+def embedding_cache_key(model_tag, document):
+    """Cache key for a document embedding: model variant plus content hash."""
+    digest = hashlib.sha1(document.rstrip('\n').encode('utf-8')).hexdigest()
+    return f"{model_tag}:{digest}"
+
+def encode_with_cache(model, documents, cache, model_tag):
+    """Encode only the documents whose embeddings are not cached yet."""
+    keys = [embedding_cache_key(model_tag, d) for d in documents]
+    cached = [cache.get(key) for key in keys]
+    misses = [i for i, value in enumerate(cached) if value is None]
+    print(f"Embedding cache: {len(documents) - len(misses)} hits, {len(misses)} misses")
+    
+    if misses:
+        new_vectors = encode(model, [documents[i] for i in misses]).astype(np.float32)
+        with cache.transact():
+            for i, vector in zip(misses, new_vectors):
+                cache.set(keys[i], vector.tobytes())
+                cached[i] = vector
+    
+    # Hits come back as raw float32 bytes
+    return np.stack([np.frombuffer(v, dtype=np.float32) if isinstance(v, bytes) else v
+                     for v in cached])
+
+def batch_encode_to_vectors(model, input_filename, output_filename, cache=None, model_tag=MODEL_NAME):
+    """Process documents in batches and generate vector embeddings.
+    
+    When a diskcache.Cache is given, embeddings of previously seen documents
+    are reused instead of re-encoded.
+    """
+    binary_filename = binary_vectors_filename(output_filename)
     print(f"Processing documents from: {input_filename}")
-    print(f"Output vectors to: {output_filename}")
+    print(f"Output vectors to: {output_filename} and {binary_filename}")
     
     # Open the file containing text
     with open(input_filename, 'r', encoding='utf-8') as documents_file:
-        # Open the file in which the vectors will be saved
-        with open(output_filename, 'w+', encoding='utf-8') as out:
+        # Open the files in which the vectors will be saved
+        with open(output_filename, 'w+', encoding='utf-8') as out, \
+                open(binary_filename, 'wb') as binary_out:
             processed = 0
             # Processing documents in batches
-            for n_lines in iter(lambda: tuple(islice(documents_file, BATCH_SIZE)), ()):
+            for n_lines in iter(lambda: list(islice(documents_file, SUPER_BATCH_SIZE)), []):
                 processed += 1
                 if processed % INFO_UPDATE_FACTOR == 0:
                     print(f"Processed {processed} batch of documents")
                 
                 # Create sentence embeddings
-                vectors = encode(model, n_lines)
+                if cache is not None:
+                    vectors = encode_with_cache(model, n_lines, cache, model_tag)
+                else:
+                    vectors = encode(model, n_lines)
+                
+                # Write the whole batch of vectors into the output file; 6
+                # significant digits is plenty for KNN and halves the file size
+                np.savetxt(out, vectors, fmt='%.6g', delimiter=',')
                 
-                # Write each vector into the output file
-                for v in vectors:
-                    out.write(','.join([str(i) for i in v]))
-                    out.write('\n')
+                # Raw float32 rows, memory-mapped by document_indexing.py
+                vectors.astype(np.float32).tofile(binary_out)
 
 def encode(model, documents):
-    """Encode documents into vectors."""
-    embeddings = model.encode(documents, show_progress_bar=True)
+    """Encode documents into vectors, preserving input order."""
+    # Sort by (approximate) token count so each mini-batch pads to a similar length
+    lengths = [len(d.split()) for d in documents]
+    order = np.argsort(lengths)
+    with torch.inference_mode():
+        embeddings = model.encode([documents[i] for i in order],
+                                  batch_size=ENCODE_BATCH_SIZE,
+                                  show_progress_bar=False,
+                                  convert_to_numpy=True,
+                                  normalize_embeddings=True)
+    
+    # Restore the original file order
+    embeddings = embeddings[np.argsort(order)]
     print(f'Vector dimension: {len(embeddings[0])}')
     return embeddings
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python vector_generation.py <input_file> <output_file>")
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    use_fp16 = '--fp16' in sys.argv[1:]
+    use_onnx = '--onnx' in sys.argv[1:]
+    use_cache = '--no-cache' not in sys.argv[1:]
+    use_compile = '--compile' in sys.argv[1:]
+    
+    if len(args) != 2:
+        print("Usage: python vector_generation.py <input_file> <output_file> [--fp16] [--onnx] [--compile] [--no-cache]")
         print("Example: python vector_generation.py data/documents_10k.tsv data/vectors_documents_10k.tsv")
         sys.exit(1)
     
-    input_filename = sys.argv[1]
-    output_filename = sys.argv[2]
+    input_filename = args[0]
+    output_filename = args[1]
     
     # Check if input file exists
     if not os.path.exists(input_filename):
@@ -76,10 +279,17 @@ def main():
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
     
     # Load model
-    model = load_model()
+    model = load_model(use_fp16, use_onnx, use_compile)
+    
+    # Embeddings differ slightly between model variants, so cache them separately
+    model_tag = embedding_cache_tag(model)
     
     # Process documents
-    batch_encode_to_vectors(model, input_filename, output_filename)
+    if use_cache:
+        with diskcache.Cache(EMBEDDING_CACHE_DIR) as cache:
+            batch_encode_to_vectors(model, input_filename, output_filename, cache, model_tag)
+    else:
+        batch_encode_to_vectors(model, input_filename, output_filename)
     
     print("Vector generation completed!")
 